@@ -1,9 +1,13 @@
 """Handles sending notifications via the configured notifiers
 """
 
-import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+
+import numpy
 import structlog
-from jinja2 import Template
+from jinja2 import Environment
 
 from notifiers.twilio_client import TwilioNotifier
 from notifiers.slack_client import SlackNotifier
@@ -12,10 +16,70 @@ from notifiers.gmail_client import GmailNotifier
 from notifiers.telegram_client import TelegramNotifier
 from notifiers.webhook_client import WebhookNotifier
 
+_JINJA_ENV = Environment(autoescape=False, auto_reload=False)
+
+
+@lru_cache(maxsize=None)
+def _compile_template(template):
+    """Compiles a Jinja template, reusing the result for identical template sources.
+
+    Args:
+        template (str): A Jinja formatted message template.
+
+    Returns:
+        Template: The compiled Jinja template.
+    """
+
+    return _JINJA_ENV.from_string(template)
+
+
+def _format_value(value):
+    """Formats a signal value for use in a message template.
+
+    Args:
+        value: The latest value of a signal.
+
+    Returns:
+        The value, with floats formatted to 8 decimal places.
+    """
+
+    if isinstance(value, float):
+        return f'{value:.8f}'
+    return value
+
+
+def _flatten_analysis(new_analysis, indicator_type):
+    """Walks the results of one indicator type across every exchange and market in a single pass.
+
+    Args:
+        new_analysis (dict): A dictionary of data related to the analysis.
+        indicator_type (str): The indicator type to walk e.g. indicators, informants or crossovers.
+
+    Yields:
+        tuple: The exchange, market, indicator, index and analysis of each result.
+    """
+
+    for exchange, exchange_results in new_analysis.items():
+        for market, market_results in exchange_results.items():
+            for indicator, indicator_results in market_results[indicator_type].items():
+                for index, analysis in enumerate(indicator_results):
+                    yield exchange, market, indicator, index, analysis
+
+
 class Notifier():
     """Handles sending notifications via the configured notifiers
     """
 
+    __slots__ = (
+        'logger', 'notifier_config', 'last_analysis', '_templates', '_pool',
+        'twilio_configured', 'twilio_client',
+        'discord_configured', 'discord_client',
+        'slack_configured', 'slack_client',
+        'gmail_configured', 'gmail_client',
+        'telegram_configured', 'telegram_client',
+        'webhook_configured', 'webhook_client'
+    )
+
     def __init__(self, notifier_config):
         """Initializes Notifier class
 
@@ -26,9 +90,10 @@ class Notifier():
         self.logger = structlog.get_logger()
         self.notifier_config = notifier_config
         self.last_analysis = dict()
+        self._templates = dict()
+        self._pool = None
 
         enabled_notifiers = list()
-        self.logger = structlog.get_logger()
         self.twilio_configured = self._validate_required_config('twilio', notifier_config)
         if self.twilio_configured:
             self.twilio_client = TwilioNotifier(
@@ -37,6 +102,7 @@ class Notifier():
                 twilio_sender_number=notifier_config['twilio']['required']['sender_number'],
                 twilio_receiver_number=notifier_config['twilio']['required']['receiver_number']
             )
+            self._add_template('twilio', notifier_config)
             enabled_notifiers.append('twilio')
 
         self.discord_configured = self._validate_required_config('discord', notifier_config)
@@ -46,6 +112,7 @@ class Notifier():
                 username=notifier_config['discord']['required']['username'],
                 avatar=notifier_config['discord']['optional']['avatar']
             )
+            self._add_template('discord', notifier_config)
             enabled_notifiers.append('discord')
 
         self.slack_configured = self._validate_required_config('slack', notifier_config)
@@ -53,6 +120,7 @@ class Notifier():
             self.slack_client = SlackNotifier(
                 slack_webhook=notifier_config['slack']['required']['webhook']
             )
+            self._add_template('slack', notifier_config)
             enabled_notifiers.append('slack')
 
         self.gmail_configured = self._validate_required_config('gmail', notifier_config)
@@ -62,6 +130,7 @@ class Notifier():
                 password=notifier_config['gmail']['required']['password'],
                 destination_addresses=notifier_config['gmail']['required']['destination_emails']
             )
+            self._add_template('gmail', notifier_config)
             enabled_notifiers.append('gmail')
 
         self.telegram_configured = self._validate_required_config('telegram', notifier_config)
@@ -70,6 +139,7 @@ class Notifier():
                 token=notifier_config['telegram']['required']['token'],
                 chat_id=notifier_config['telegram']['required']['chat_id']
             )
+            self._add_template('telegram', notifier_config)
             enabled_notifiers.append('telegram')
 
         self.webhook_configured = self._validate_required_config('webhook', notifier_config)
@@ -81,6 +151,9 @@ class Notifier():
             )
             enabled_notifiers.append('webhook')
 
+        if enabled_notifiers:
+            self._pool = ThreadPoolExecutor(max_workers=len(enabled_notifiers))
+
         self.logger.info('enabled notifers: %s', enabled_notifiers)
 
 
@@ -91,12 +164,36 @@ class Notifier():
             new_analysis (dict): The new_analysis to send.
         """
 
-        self.notify_slack(new_analysis)
-        self.notify_discord(new_analysis)
-        self.notify_twilio(new_analysis)
-        self.notify_gmail(new_analysis)
-        self.notify_telegram(new_analysis)
-        self.notify_webhook(new_analysis)
+        if not self._pool:
+            return
+
+        # Alert state is resolved once and every message is rendered before anything is
+        # dispatched as the webhook notifier rewrites new_analysis in place.
+        pending = dict()
+        if self._templates:
+            alert_contexts = self._collect_alert_contexts(new_analysis)
+            for notifier, message_template in self._templates.items():
+                message = self._render(message_template, alert_contexts)
+                future = self._pool.submit(
+                    self._send_message,
+                    getattr(self, '{}_client'.format(notifier)),
+                    message
+                )
+                pending[future] = notifier
+        if self.webhook_configured:
+            pending[self._pool.submit(self.notify_webhook, new_analysis)] = 'webhook'
+
+        wait(pending)
+
+        errors = list()
+        for future, notifier in pending.items():
+            error = future.exception()
+            if error:
+                self.logger.error('%s notification failed: %s', notifier, error)
+                errors.append(error)
+
+        if errors:
+            raise errors[0]
 
 
     def notify_discord(self, new_analysis):
@@ -106,13 +203,12 @@ class Notifier():
             new_analysis (dict): The new_analysis to send.
         """
 
-        if self.discord_configured:
-            message = self._message_templater(
-                new_analysis,
-                self.notifier_config['discord']['optional']['template']
+        if 'discord' in self._templates:
+            message = self._render(
+                self._templates['discord'],
+                self._collect_alert_contexts(new_analysis)
             )
-            if message.strip():
-                self.discord_client.notify(message)
+            self._send_message(self.discord_client, message)
 
 
     def notify_slack(self, new_analysis):
@@ -122,13 +218,12 @@ class Notifier():
             new_analysis (dict): The new_analysis to send.
         """
 
-        if self.slack_configured:
-            message = self._message_templater(
-                new_analysis,
-                self.notifier_config['slack']['optional']['template']
+        if 'slack' in self._templates:
+            message = self._render(
+                self._templates['slack'],
+                self._collect_alert_contexts(new_analysis)
             )
-            if message.strip():
-                self.slack_client.notify(message)
+            self._send_message(self.slack_client, message)
 
 
     def notify_twilio(self, new_analysis):
@@ -138,13 +233,12 @@ class Notifier():
             new_analysis (dict): The new_analysis to send.
         """
 
-        if self.twilio_configured:
-            message = self._message_templater(
-                new_analysis,
-                self.notifier_config['twilio']['optional']['template']
+        if 'twilio' in self._templates:
+            message = self._render(
+                self._templates['twilio'],
+                self._collect_alert_contexts(new_analysis)
             )
-            if message.strip():
-                self.twilio_client.notify(message)
+            self._send_message(self.twilio_client, message)
 
 
     def notify_gmail(self, new_analysis):
@@ -154,13 +248,12 @@ class Notifier():
             new_analysis (dict): The new_analysis to send.
         """
 
-        if self.gmail_configured:
-            message = self._message_templater(
-                new_analysis,
-                self.notifier_config['gmail']['optional']['template']
+        if 'gmail' in self._templates:
+            message = self._render(
+                self._templates['gmail'],
+                self._collect_alert_contexts(new_analysis)
             )
-            if message.strip():
-                self.gmail_client.notify(message)
+            self._send_message(self.gmail_client, message)
 
 
     def notify_telegram(self, new_analysis):
@@ -170,13 +263,12 @@ class Notifier():
             new_analysis (dict): The new_analysis to send.
         """
 
-        if self.telegram_configured:
-            message = self._message_templater(
-                new_analysis,
-                self.notifier_config['telegram']['optional']['template']
+        if 'telegram' in self._templates:
+            message = self._render(
+                self._templates['telegram'],
+                self._collect_alert_contexts(new_analysis)
             )
-            if message.strip():
-                self.telegram_client.notify(message)
+            self._send_message(self.telegram_client, message)
 
 
     def notify_webhook(self, new_analysis):
@@ -187,16 +279,53 @@ class Notifier():
         """
 
         if self.webhook_configured:
-            for exchange in new_analysis:
-                for market in new_analysis[exchange]:
-                    for indicator_type in new_analysis[exchange][market]:
-                        for indicator in new_analysis[exchange][market][indicator_type]:
-                            for index, analysis in enumerate(new_analysis[exchange][market][indicator_type][indicator]):
-                                new_analysis[exchange][market][indicator_type][indicator][index] = analysis['result'].to_dict(orient='records')[-1]
+            # Exchange, market, indicator type and indicator dicts sit above the lists of
+            # results, the latest row replaces each result in its list.
+            pending = deque([(0, new_analysis)])
+            while pending:
+                depth, node = pending.pop()
+                if depth == 4:
+                    for index, analysis in enumerate(node):
+                        # Numpy scalars are converted to native types so the payload is JSON
+                        # serializable.
+                        node[index] = {
+                            column: value.item() if isinstance(value, numpy.generic) else value
+                            for column, value in analysis['result'].iloc[-1].items()
+                        }
+                else:
+                    pending.extend((depth + 1, child) for child in node.values())
 
             self.webhook_client.notify(new_analysis)
 
 
+    def _add_template(self, notifier, notifier_config):
+        """Compile and register a notifier's message template, skipping blank templates.
+
+        Notifiers without a registered template never collect alerts just to render an
+        empty message.
+
+        Args:
+            notifier (str): The name of the notifier key in default-config.json
+            notifier_config (dict): A dictionary containing configuration for the notifications.
+        """
+
+        template = notifier_config[notifier]['optional']['template']
+        if template.strip():
+            self._templates[notifier] = _compile_template(template)
+
+
+    def _send_message(self, client, message):
+        """Send a templated message via a notifier client if there is anything to send.
+
+        Args:
+            client (NotifierUtils): The notifier client to send the message with.
+            message (str): The templated message.
+        """
+
+        if message:
+            client.notify(message)
+
+
     def _validate_required_config(self, notifier, notifier_config):
         """Validate the required configuration items are present for a notifier.
 
@@ -208,74 +337,91 @@ class Notifier():
             bool: Is the notifier configured?
         """
 
-        notifier_configured = True
-        for _, val in notifier_config[notifier]['required'].items():
-            if not val:
-                notifier_configured = False
-        return notifier_configured
+        return all(notifier_config[notifier]['required'].values())
 
 
-    def _message_templater(self, new_analysis, template):
-        """Creates a message from a user defined template
+    def _collect_alert_contexts(self, new_analysis):
+        """Works out which analyses should alert and builds the template context for each
 
         Args:
             new_analysis (dict): A dictionary of data related to the analysis to send a message about.
-            template (str): A Jinja formatted message template.
 
         Returns:
-            str: The templated messages for the notifier.
+            list: A template context (dict) for each analysis that should alert.
         """
 
         if not self.last_analysis:
             self.last_analysis = new_analysis
 
-        message_template = Template(template)
+        alert_contexts = list()
+        for exchange, market, indicator, index, analysis in _flatten_analysis(new_analysis, 'indicators'):
+            analysis_config = analysis['config']
+            # Read the last value straight from each column rather than materialising
+            # the whole last row as a Series.
+            result = analysis['result']
+            is_hot = result['is_hot'].values[-1]
+            is_cold = result['is_cold'].values[-1]
+
+            status = 'neutral'
+            if is_hot:
+                status = 'hot'
+            elif is_cold:
+                status = 'cold'
+
+            if is_hot or is_cold:
+                last_status = str()
+                last_indicators = self.last_analysis.get(exchange, {}).get(market, {}).get('indicators', {})
+                last_results = last_indicators.get(indicator, [])
+                if index < len(last_results):
+                    last_status = last_results[index].get('status', str())
+
+                should_alert = True
+                if analysis_config['alert_frequency'] == 'once':
+                    if last_status == status:
+                        should_alert = False
+
+                if not analysis_config['alert_enabled']:
+                    should_alert = False
+
+                if should_alert:
+                    # Signal values are only needed for the message so they are read and
+                    # formatted for alerting analyses only.
+                    values = {
+                        signal: _format_value(result[signal].values[-1])
+                        for signal in analysis_config['signal']
+                    }
+
+                    analysis['status'] = status
+                    alert_contexts.append({
+                        'values': values,
+                        'exchange': exchange,
+                        'market': market,
+                        'indicator': indicator,
+                        'indicator_number': index,
+                        'analysis': analysis,
+                        'status': status,
+                        'last_status': last_status
+                    })
+
+        # Merge changes from new analysis into last analysis, rendering only needs the contexts.
+        self.last_analysis.update(new_analysis)
+        return alert_contexts
+
+
+    def _render(self, message_template, alert_contexts):
+        """Creates a message from a user defined template
+
+        Args:
+            message_template (Template): A compiled Jinja message template.
+            alert_contexts (list): The template contexts from _collect_alert_contexts.
+
+        Returns:
+            str: The templated messages for the notifier, empty if every alert rendered blank.
+        """
+
         new_message = str()
-        for exchange in new_analysis:
-            for market in new_analysis[exchange]:
-                for indicator in new_analysis[exchange][market]['indicators']:
-                    for index, analysis in enumerate(new_analysis[exchange][market]['indicators'][indicator]):
-                        values = dict()
-                        for signal in analysis['config']['signal']:
-                            latest_result = analysis['result'].iloc[-1]
-
-                            values[signal] = analysis['result'].iloc[-1][signal]
-                            if isinstance(values[signal], float):
-                                values[signal] = format(values[signal], '.8f')
-
-                        status = 'neutral'
-                        if latest_result['is_hot']:
-                            status = 'hot'
-                        elif latest_result['is_cold']:
-                            status = 'cold'
-
-                        if latest_result['is_hot'] or latest_result['is_cold']:
-                            try:
-                                last_status = self.last_analysis[exchange][market]['indicators'][indicator][index]['status']
-                            except:
-                                last_status = str()
-
-                            should_alert = True
-                            if analysis['config']['alert_frequency'] == 'once':
-                                if last_status == status:
-                                    should_alert = False
-
-                            if not analysis['config']['alert_enabled']:
-                                should_alert = False
-
-                            if should_alert:
-                                new_analysis[exchange][market]['indicators'][indicator][index]['status'] = status
-                                new_message += message_template.render(
-                                    values=values,
-                                    exchange=exchange,
-                                    market=market,
-                                    indicator=indicator,
-                                    indicator_number=index,
-                                    analysis=analysis,
-                                    status=status,
-                                    last_status=last_status
-                                )
-
-        # Merge changes from new analysis into last analysis
-        self.last_analysis = {**self.last_analysis, **new_analysis}
+        for alert_context in alert_contexts:
+            message = message_template.render(**alert_context)
+            if message.strip():
+                new_message += message
         return new_message